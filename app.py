@@ -1,21 +1,63 @@
 from flask import Flask, render_template, jsonify, request, redirect, url_for, flash
+from flask.json.provider import DefaultJSONProvider
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
+import orjson
 import requests
+import redis
+import pybreaker
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
+import re
+import secrets
+import threading
+import time
+from types import MappingProxyType
+from operator import itemgetter
+from contextlib import contextmanager
 import psycopg2
+from psycopg2 import pool
 from dotenv import load_dotenv
 
+# gevent只在gunicorn部署时使用，Vercel等环境可以不安装
+try:
+    from gevent import monkey as _gevent_monkey, get_hub as _gevent_hub
+except ImportError:
+    _gevent_monkey = None
+
 # 只在本地加载环境变量
 if os.path.exists('.env.local'):
     load_dotenv('.env.local')
 
+class ORJSONProvider(DefaultJSONProvider):
+    """使用orjson序列化响应，中文直接输出为UTF-8而不是\\u转义"""
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        # session反序列化会传入object_hook还原元组等类型，orjson不支持，交给默认实现
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
 # 明确指定静态文件和模板路径
 app = Flask(__name__, 
     static_folder='static',
     static_url_path='/static',
     template_folder='templates'
 )
+app.json = ORJSONProvider(app)
 
 # 从环境变量获取配置
 secret_key = os.getenv('SECRET_KEY', 'vercel-default-secret-key-change-in-production')
@@ -40,103 +82,415 @@ DB_CONFIG = {
 AMAP_WEB_KEY = os.getenv('AMAP_WEB_KEY')
 AMAP_SERVICE_KEY = os.getenv('AMAP_SERVICE_KEY')
 
+# 高德API请求复用同一个Session，保持连接池中的长连接
+AMAP_TIMEOUT = (3.05, 10)
+SESSION = requests.Session()
+SESSION.headers.update({'User-Agent': 'sklayan-map/1.0'})
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=50,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.25,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(['GET'])
+    )
+))
+# 高德API连续失败时熔断，30秒内直接返回错误，不再占用worker等待超时和重试
+AMAP_BREAKER = pybreaker.CircuitBreaker(fail_max=10, reset_timeout=30)
+
+REDIS_HOST = os.getenv('REDIS_HOST')
+redis_client = redis.Redis(
+    host=REDIS_HOST,
+    port=int(os.getenv('REDIS_PORT', 6379)),
+    password=os.getenv('REDIS_PASSWORD'),
+    decode_responses=True,
+    socket_timeout=0.5
+) if REDIS_HOST else None
+
+class ResultCache:
+    """高德API结果缓存：进程内TTL缓存，可选Redis作为跨实例共享后端"""
+
+    def __init__(self, maxsize, ttl, use_redis=False):
+        self.ttl = ttl
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.redis = redis_client if use_redis else None
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        if self.redis is not None:
+            try:
+                value = self.redis.get(key)
+                return orjson.loads(value) if value is not None else None
+            except redis.RedisError as e:
+                print(f"⚠️ Redis读取失败，使用本地缓存: {e}")
+        with self.lock:
+            return self.local.get(key)
+
+    def set(self, key, value):
+        if self.redis is not None:
+            try:
+                self.redis.setex(key, self.ttl, orjson.dumps(value))
+                return
+            except redis.RedisError as e:
+                print(f"⚠️ Redis写入失败，使用本地缓存: {e}")
+        with self.lock:
+            self.local[key] = value
+
+# 地理编码结果对同一输入是确定的，缓存一天以节省高德API配额
+GEO_CACHE = ResultCache(maxsize=10000, ttl=86400)
+RGEO_CACHE = ResultCache(maxsize=10000, ttl=86400)
+# POI搜索结果缓存10分钟；配置了Redis时跨实例共享
+POI_CACHE = ResultCache(maxsize=2000, ttl=600, use_redis=True)
+
+# 高德接口地址和固定参数在导入时构建一次，请求时只合并动态参数
+AMAP_BASE_PARAMS = MappingProxyType({'key': AMAP_SERVICE_KEY, 'output': 'JSON'})
+AMAP_GEOCODE_URL = 'https://restapi.amap.com/v3/geocode/geo'
+AMAP_REGEOCODE_URL = 'https://restapi.amap.com/v3/geocode/regeo'
+AMAP_POI_URL = 'https://restapi.amap.com/v3/place/around'
+POI_RADIUS = 5000
+POI_OFFSET = 20
+
+class RateLimiter:
+    """固定窗口限流：配置了Redis时跨实例计数，Redis不可用时按进程计数"""
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.local = TTLCache(maxsize=10000, ttl=window)
+        self.lock = threading.Lock()
+
+    def allow(self, key):
+        key = f'{key}:{int(time.time() // self.window)}'
+        if redis_client is not None:
+            try:
+                pipe = redis_client.pipeline()
+                pipe.incr(key)
+                pipe.expire(key, self.window)
+                count = pipe.execute()[0]
+                return count <= self.limit
+            except redis.RedisError as e:
+                print(f"⚠️ Redis限流计数失败，使用本地计数: {e}")
+        with self.lock:
+            count = self.local.get(key, 0) + 1
+            self.local[key] = count
+        return count <= self.limit
+
+# 每个用户每分钟最多实际请求高德API的次数，防止单个用户耗尽配额或占满worker；
+# 只在真正发出上游请求时计数，缓存命中、合并到进行中请求和参数校验失败都不计数
+AMAP_RATE_LIMITER = RateLimiter(limit=int(os.getenv('AMAP_RATE_LIMIT', 60)), window=60)
+_RATE_LIMITED_BODY = orjson.dumps({'error': '请求过于频繁，请稍后再试'}) + b'\n'
+
+class AmapRateLimited(Exception):
+    pass
+
+@app.errorhandler(AmapRateLimited)
+def amap_rate_limited(e):
+    return app.response_class(_RATE_LIMITED_BODY, status=429, mimetype='application/json')
+
+def _amap_fetch(url, params, shape, error):
+    if not AMAP_RATE_LIMITER.allow(f'ratelimit:amap:{current_user.id}'):
+        raise AmapRateLimited()
+    try:
+        response = AMAP_BREAKER.call(
+            SESSION.get,
+            url,
+            params={**AMAP_BASE_PARAMS, **params},
+            timeout=AMAP_TIMEOUT
+        )
+        data = orjson.loads(response.content)
+        result = shape(data) if data['status'] == '1' else None
+    except pybreaker.CircuitBreakerError:
+        return {'success': False, 'error': '高德API暂时不可用，请稍后重试'}
+    except requests.RequestException as e:
+        # requests/urllib3的异常信息包含带key参数的完整URL，不能返回给客户端，日志也只记录类型
+        print(f"⚠️ 高德API请求失败: {type(e).__name__}")
+        return {'success': False, 'error': '高德API请求失败，请稍后重试'}
+    except Exception as e:
+        return {'success': False, 'error': str(e)}
+
+    if result is None:
+        return {'success': False, 'error': data.get('info', error)}
+    return result
+
+class _InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+# 同一缓存键的并发请求只发出一次高德调用，其余请求等待并共享结果（如地图平移时的重复逆地理编码）
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+def _amap_call(url, params, shape, error, cache=None, cache_key=None):
+    """调用高德Web服务API，成功时由shape提取所需字段；shape返回None视为失败"""
+    if not AMAP_SERVICE_KEY:
+        return {'success': False, 'error': '高德API配置缺失'}
+
+    if cache is None:
+        return _amap_fetch(url, params, shape, error)
+
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    with _inflight_lock:
+        call = _inflight.get(cache_key)
+        leader = call is None
+        if leader:
+            call = _inflight[cache_key] = _InFlightCall()
+    if not leader:
+        call.done.wait()
+        if call.result is None:
+            # 领头请求被限流，没有结果可共享，由本请求自行发起（并按自己的额度计数）
+            return _amap_call(url, params, shape, error, cache, cache_key)
+        return call.result
+
+    try:
+        call.result = _amap_fetch(url, params, shape, error)
+        if call.result['success']:
+            cache.set(cache_key, call.result)
+    finally:
+        with _inflight_lock:
+            del _inflight[cache_key]
+        call.done.set()
+    return call.result
+
+# 密码哈希使用argon2id，默认参数按单次校验约50ms标定，可通过环境变量调整；
+# 参数变化后旧哈希会在用户下次登录时自动升级
+PH = PasswordHasher(
+    time_cost=int(os.getenv('ARGON2_TIME_COST', 2)),
+    memory_cost=int(os.getenv('ARGON2_MEMORY_COST', 19456)),
+    parallelism=int(os.getenv('ARGON2_PARALLELISM', 1))
+)
+
+# gevent worker中argon2运算会阻塞hub，同一worker的其他请求都要等待；
+# 交给hub的原生线程池执行（argon2和hashlib计算时释放GIL），协程只需等待结果
+def run_cpu_bound(fn, *args):
+    if _gevent_monkey is not None and _gevent_monkey.is_module_patched('threading'):
+        return _gevent_hub().threadpool.apply(fn, args)
+    return fn(*args)
+
+def hash_password(password):
+    return run_cpu_bound(PH.hash, password)
+
+# 用户名不存在时也校验一次哈希，使其与密码错误耗时一致，避免通过响应时间枚举用户名
+DUMMY_HASH = hash_password(secrets.token_hex(16))
+
+def _verify_password(stored_hash, password):
+    if not stored_hash.startswith('$argon2'):
+        return check_password_hash(stored_hash, password)
+    try:
+        return PH.verify(stored_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+def verify_password(stored_hash, password):
+    """校验密码，兼容迁移前werkzeug生成的pbkdf2哈希"""
+    return run_cpu_bound(_verify_password, stored_hash, password)
+
+def password_needs_rehash(stored_hash):
+    return not stored_hash.startswith('$argon2') or PH.check_needs_rehash(stored_hash)
+
 class User(UserMixin):
     def __init__(self, id, username, email):
         self.id = id
         self.username = username
         self.email = email
 
+# Flask-Login每个请求只调用一次load_user，但每个已登录请求都要查一次库；
+# 用户资料几乎不变，查询结果在进程内缓存60秒
+USER_CACHE = TTLCache(maxsize=4096, ttl=60)
+_user_cache_lock = threading.Lock()
+
 @login_manager.user_loader
 def load_user(user_id):
-    conn = None
-    cur = None
-    try:
-        conn = get_db_connection()
-        if conn is None:
+    with _user_cache_lock:
+        user_data = USER_CACHE.get(user_id)
+    if user_data is None:
+        # 数据库或连接池出错时直接抛出，不能当作用户不存在而把已登录用户视为匿名
+        with db_cursor() as cur:
+            cur.execute('SELECT id, username, email FROM users WHERE id = %s', (user_id,))
+            user_data = cur.fetchone()
+        if user_data is None:
             return None
-        cur = conn.cursor()
-        cur.execute('SELECT id, username, email FROM users WHERE id = %s', (user_id,))
-        user_data = cur.fetchone()
-        if user_data:
-            return User(id=user_data[0], username=user_data[1], email=user_data[2])
-        return None
-    except Exception as e:
-        print(f"加载用户失败: {e}")
-        return None
-    finally:
-        if cur:
-            cur.close()
-        if conn:
+        with _user_cache_lock:
+            USER_CACHE[user_id] = user_data
+    return User(id=user_data[0], username=user_data[1], email=user_data[2])
+
+# 数据库连接池，首次使用时创建，避免每个请求重新建立连接
+# 连接池按进程创建：fork出的worker不能复用父进程的socket，发现PID变化时重新建池
+# psycopg2建池时立即打开minconn个连接，因此保持较小，避免冷启动和多worker时一次性建立大量连接；
+# 空闲连接的保留上限由BlockingConnectionPool._putconn改为maxconn
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 2))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+DB_POOL = None
+_db_pool_pid = None
+_db_pool_lock = threading.Lock()
+
+class BlockingConnectionPool(pool.ThreadedConnectionPool):
+    """连接全部借出时getconn排队等待归还，而不是立即抛出PoolError；gevent下信号量是协作式的"""
+
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        self._slots = threading.BoundedSemaphore(maxconn)
+        super().__init__(minconn, maxconn, *args, **kwargs)
+
+    def getconn(self, key=None):
+        if not self._slots.acquire(timeout=DB_POOL_TIMEOUT):
+            raise pool.PoolError('等待数据库连接超时')
+        try:
+            return super().getconn(key)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self._slots.release()
+
+    def _putconn(self, conn, key=None, close=False):
+        """与psycopg2原实现相同，但空闲连接最多保留maxconn个而不是minconn个，
+        避免并发超过minconn后每次归还都关闭连接、下次借出重新握手"""
+        if self.closed:
+            raise pool.PoolError('connection pool is closed')
+        if key is None:
+            key = self._rused.get(id(conn))
+            if key is None:
+                raise pool.PoolError('trying to put unkeyed connection')
+
+        if len(self._pool) < self.maxconn and not close and not conn.closed:
+            status = conn.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                conn.close()
+            else:
+                if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                self._pool.append(conn)
+        else:
             conn.close()
 
-def get_db_connection():
+        if not self.closed or key in self._used:
+            del self._used[key]
+            del self._rused[id(conn)]
+
+def get_db_pool():
+    global DB_POOL, _db_pool_pid
+    pid = os.getpid()
+    if DB_POOL is None or _db_pool_pid != pid:
+        with _db_pool_lock:
+            if DB_POOL is None or _db_pool_pid != pid:
+                # 不关闭继承来的连接，关闭会向服务端发送终止消息，影响父进程
+                DB_POOL = BlockingConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX, **DB_CONFIG
+                )
+                _db_pool_pid = pid
+    return DB_POOL
+
+@contextmanager
+def db_cursor(commit=False):
+    """从连接池获取游标；commit=True时正常退出后提交，出错时回滚，结束后保证连接归还连接池"""
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        return conn
-    except Exception as e:
-        print(f"❌ 数据库连接失败: {e}")
-        return None
+        with conn.cursor() as cur:
+            yield cur
+        if commit:
+            conn.commit()
+    except BaseException:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        db_pool.putconn(conn)
 
 def init_db():
     """初始化数据库表"""
-    conn = get_db_connection()
-    if conn is None:
-        print("❌ 无法连接到数据库，跳过初始化")
-        return
-        
-    cur = None
     try:
-        cur = conn.cursor()
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                username VARCHAR(80) UNIQUE NOT NULL,
-                email VARCHAR(120) UNIQUE NOT NULL,
-                password_hash VARCHAR(255) NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        conn.commit()
+        with db_cursor(commit=True) as cur:
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    id SERIAL PRIMARY KEY,
+                    username VARCHAR(80) UNIQUE NOT NULL,
+                    email VARCHAR(120) UNIQUE NOT NULL,
+                    password_hash VARCHAR(255) NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
         print("✅ 数据库初始化成功")
     except Exception as e:
         print(f"❌ 数据库初始化失败: {e}")
-    finally:
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
 
-# 初始化数据库
-init_db()
+@app.cli.command('init-db')
+def init_db_command():
+    """建表：部署后执行一次 flask --app app init-db"""
+    init_db()
+
+# 建表不在每次冷启动时执行；需要时设置 RUN_DB_INIT=1 或使用 init-db 命令
+if os.getenv('RUN_DB_INIT') == '1':
+    init_db()
+
+# 地图页只随用户名变化，渲染结果按用户名缓存，跳过每次的Jinja渲染
+MAP_PAGE_CACHE = TTLCache(maxsize=1024, ttl=600)
+_map_page_lock = threading.Lock()
+
+def render_map_page(username):
+    if app.debug:
+        return render_template('map.html', map_key=AMAP_WEB_KEY, username=username)
+    with _map_page_lock:
+        page = MAP_PAGE_CACHE.get(username)
+    if page is None:
+        page = render_template('map.html', map_key=AMAP_WEB_KEY, username=username)
+        with _map_page_lock:
+            MAP_PAGE_CACHE[username] = page
+    return page
 
 @app.route('/')
 def index():
     if current_user.is_authenticated:
-        return render_template('map.html', map_key=AMAP_WEB_KEY, username=current_user.username)
+        return render_map_page(current_user.username)
     else:
         return redirect(url_for('login'))
 
+def rehash_password(user_id, password):
+    """登录成功时将旧格式哈希升级为当前argon2参数"""
+    password_hash = hash_password(password)
+    try:
+        with db_cursor(commit=True) as cur:
+            cur.execute('UPDATE users SET password_hash = %s WHERE id = %s', (password_hash, user_id))
+    except Exception as e:
+        print(f"更新密码哈希失败: {e}")
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
         return redirect(url_for('index'))
 
     if request.method == 'POST':
-        username = request.form.get('username')
-        password = request.form.get('password')
-
-        conn = get_db_connection()
-        if conn is None:
-            flash('数据库连接失败', 'error')
+        raw_username = request.form.get('username', '')
+        username = raw_username.strip()
+        password = request.form.get('password', '')
+        if not username or not password:
+            flash('用户名或密码错误', 'error')
             return render_template('login.html')
 
-        cur = None
         try:
-            cur = conn.cursor()
-            cur.execute('SELECT id, username, email, password_hash FROM users WHERE username = %s', (username,))
-            user_data = cur.fetchone()
-
-            if user_data and check_password_hash(user_data[3], password):
+            # 注册时用户名已去除首尾空白；早期账号可能带空白，精确匹配原始输入作为后备，优先去空白后的结果
+            with db_cursor() as cur:
+                cur.execute(
+                    'SELECT id, username, email, password_hash FROM users WHERE username IN (%s, %s) '
+                    'ORDER BY username = %s DESC LIMIT 1',
+                    (username, raw_username, username)
+                )
+                user_data = cur.fetchone()
+
+            stored_hash = user_data[3] if user_data else DUMMY_HASH
+            password_ok = verify_password(stored_hash, password)
+            if user_data and password_ok:
+                if password_needs_rehash(user_data[3]):
+                    rehash_password(user_data[0], password)
                 user = User(id=user_data[0], username=user_data[1], email=user_data[2])
                 login_user(user)
                 next_page = request.args.get('next')
@@ -146,29 +500,37 @@ def login():
 
         except Exception as e:
             flash(f'登录失败: {str(e)}', 'error')
-        finally:
-            if cur:
-                cur.close()
-            if conn:
-                conn.close()
 
     return render_template('login.html')
 
+# 注册表单校验规则，长度与users表的列定义一致
+USERNAME_MAX_LENGTH = 80
+EMAIL_MAX_LENGTH = 120
+EMAIL_RE = re.compile(r'[^@\s]+@[^@\s]+\.[^@\s]+')
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if current_user.is_authenticated:
         return redirect(url_for('index'))
 
     if request.method == 'POST':
-        username = request.form.get('username')
-        email = request.form.get('email')
-        password = request.form.get('password')
-        confirm_password = request.form.get('confirm_password')
+        username = request.form.get('username', '').strip()
+        email = request.form.get('email', '').strip()
+        password = request.form.get('password', '')
+        confirm_password = request.form.get('confirm_password', '')
 
         if not username or not email or not password:
             flash('请填写所有字段', 'error')
             return render_template('register.html')
 
+        if len(username) > USERNAME_MAX_LENGTH or len(email) > EMAIL_MAX_LENGTH:
+            flash('用户名或邮箱过长', 'error')
+            return render_template('register.html')
+
+        if not EMAIL_RE.fullmatch(email):
+            flash('邮箱格式不正确', 'error')
+            return render_template('register.html')
+
         if password != confirm_password:
             flash('密码确认不匹配', 'error')
             return render_template('register.html')
@@ -177,38 +539,34 @@ def register():
             flash('密码长度至少6位', 'error')
             return render_template('register.html')
 
-        conn = get_db_connection()
-        if conn is None:
-            flash('数据库连接失败', 'error')
-            return render_template('register.html')
-
-        cur = None
+        password_hash = hash_password(password)
         try:
-            cur = conn.cursor()
-            cur.execute('SELECT id FROM users WHERE username = %s OR email = %s', (username, email))
-            if cur.fetchone():
-                flash('用户名或邮箱已存在', 'error')
-                return render_template('register.html')
-
-            password_hash = generate_password_hash(password)
-            cur.execute(
-                'INSERT INTO users (username, email, password_hash) VALUES (%s, %s, %s) RETURNING id',
-                (username, email, password_hash)
-            )
-            conn.commit()
+            # 直接插入，由唯一索引判重；冲突时才再查询是哪个字段重复
+            with db_cursor(commit=True) as cur:
+                cur.execute(
+                    'INSERT INTO users (username, email, password_hash) VALUES (%s, %s, %s) '
+                    'ON CONFLICT DO NOTHING RETURNING id',
+                    (username, email, password_hash)
+                )
+                if cur.fetchone() is None:
+                    cur.execute(
+                        'SELECT bool_or(username = %s), bool_or(email = %s) FROM users WHERE username = %s OR email = %s',
+                        (username, email, username, email)
+                    )
+                    username_taken, email_taken = cur.fetchone()
+                    if username_taken:
+                        flash('用户名已存在', 'error')
+                    elif email_taken:
+                        flash('邮箱已存在', 'error')
+                    else:
+                        flash('用户名或邮箱已存在', 'error')
+                    return render_template('register.html')
             flash('注册成功！请登录。', 'success')
             return redirect(url_for('login'))
 
         except Exception as e:
-            if conn:
-                conn.rollback()
             flash(f'注册失败: {str(e)}', 'error')
             return render_template('register.html')
-        finally:
-            if cur:
-                cur.close()
-            if conn:
-                conn.close()
 
     return render_template('register.html')
 
@@ -219,43 +577,114 @@ def logout():
     flash('您已成功退出登录', 'success')
     return redirect(url_for('login'))
 
+def _format_geocode(geocode):
+    lng, lat = geocode['location'].split(',')
+    return {
+        'success': True,
+        'location': {
+            'lng': float(lng),
+            'lat': float(lat)
+        },
+        'formatted_address': geocode['formatted_address'],
+        'district': geocode.get('district', '')
+    }
+
+def _shape_geocode(data):
+    if not data['geocodes']:
+        return None
+    return _format_geocode(data['geocodes'][0])
+
+def _shape_geocode_batch(data):
+    # 批量模式下解析失败的地址对应的location为空列表
+    results = []
+    for geocode in data['geocodes']:
+        if isinstance(geocode.get('location'), str) and geocode['location']:
+            results.append(_format_geocode(geocode))
+        else:
+            results.append({'success': False, 'error': '地址解析失败'})
+    return {'success': True, 'results': results}
+
+def _shape_reverse_geocode(data):
+    address_component = data['regeocode']['addressComponent']
+    return {
+        'success': True,
+        'address': data['regeocode']['formatted_address'],
+        'province': address_component.get('province', ''),
+        'city': address_component.get('city', ''),
+        'district': address_component.get('district', '')
+    }
+
+POI_FIELDS = ('id', 'name', 'type', 'address', 'location', 'distance')
+_poi_values = itemgetter(*POI_FIELDS)
+
+def _shape_search_poi(data):
+    return {
+        'success': True,
+        'pois': [dict(zip(POI_FIELDS, _poi_values(poi))) for poi in data.get('pois', [])]
+    }
+
+# 参数校验失败的响应体固定不变，导入时序列化一次；Response对象每次新建，避免跨请求共享可变状态
+_BAD_REQUEST_BODIES = {
+    message: orjson.dumps({'error': message}) + b'\n'
+    for message in ('地址参数缺失', '坐标参数缺失', '坐标参数无效', '参数缺失')
+}
+
+def bad_request(message):
+    return app.response_class(_BAD_REQUEST_BODIES[message], status=400, mimetype='application/json')
+
+def _round_location(location):
+    """坐标保留三位小数（约100米精度），用作缓存键"""
+    return ','.join(f'{float(v):.3f}' for v in location.split(','))
+
 @app.route('/geocode')
 @login_required
 def geocode():
     address = request.args.get('address', '')
     if not address:
-        return jsonify({'error': '地址参数缺失'}), 400
+        return bad_request('地址参数缺失')
 
-    if not AMAP_SERVICE_KEY:
-        return jsonify({'success': False, 'error': '高德API配置缺失'})
+    return jsonify(_amap_call(
+        AMAP_GEOCODE_URL, {'address': address}, _shape_geocode, '地址解析失败',
+        cache=GEO_CACHE, cache_key=f'geo:{address.strip().lower()}'
+    ))
 
-    url = 'https://restapi.amap.com/v3/geocode/geo'
-    params = {
-        'address': address,
-        'key': AMAP_SERVICE_KEY,
-        'output': 'JSON'
-    }
+# 高德地理编码批量模式单次最多10个地址
+GEOCODE_BATCH_MAX = 10
 
-    try:
-        response = requests.get(url, params=params, timeout=10)
-        data = response.json()
-
-        if data['status'] == '1' and data['geocodes']:
-            location = data['geocodes'][0]['location']
-            lng, lat = location.split(',')
-            return jsonify({
-                'success': True,
-                'location': {
-                    'lng': float(lng),
-                    'lat': float(lat)
-                },
-                'formatted_address': data['geocodes'][0]['formatted_address'],
-                'district': data['geocodes'][0].get('district', '')
-            })
-        else:
-            return jsonify({'success': False, 'error': data.get('info', '地址解析失败')})
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)})
+@app.route('/geocode_batch')
+@login_required
+def geocode_batch():
+    addresses = [a for a in request.args.get('addresses', '').split('|') if a.strip()][:GEOCODE_BATCH_MAX]
+    if not addresses:
+        return bad_request('地址参数缺失')
+
+    results = {}
+    for address in addresses:
+        cached = GEO_CACHE.get(f'geo:{address.strip().lower()}')
+        if cached is not None:
+            results[address] = cached
+    missing = list(dict.fromkeys(a for a in addresses if a not in results))
+
+    if missing:
+        batch = _amap_call(
+            AMAP_GEOCODE_URL, {'address': '|'.join(missing), 'batch': 'true'},
+            _shape_geocode_batch, '地址解析失败'
+        )
+        if not batch['success']:
+            return jsonify(batch)
+        for i, address in enumerate(missing):
+            if i < len(batch['results']):
+                result = batch['results'][i]
+            else:
+                result = {'success': False, 'error': '地址解析失败'}
+            results[address] = result
+            if result['success']:
+                GEO_CACHE.set(f'geo:{address.strip().lower()}', result)
+
+    return jsonify({
+        'success': True,
+        'results': [{'address': address, **results[address]} for address in addresses]
+    })
 
 @app.route('/reverse_geocode')
 @login_required
@@ -264,38 +693,19 @@ def reverse_geocode():
     lat = request.args.get('lat', '')
 
     if not lng or not lat:
-        return jsonify({'error': '坐标参数缺失'}), 400
-
-    if not AMAP_SERVICE_KEY:
-        return jsonify({'success': False, 'error': '高德API配置缺失'})
-
-    url = 'https://restapi.amap.com/v3/geocode/regeo'
-    params = {
-        'location': f'{lng},{lat}',
-        'key': AMAP_SERVICE_KEY,
-        'output': 'JSON',
-        'extensions': 'base'
-    }
+        return bad_request('坐标参数缺失')
 
+    location = lng + ',' + lat
     try:
-        response = requests.get(url, params=params, timeout=10)
-        data = response.json()
-
-        if data['status'] == '1':
-            address_component = data['regeocode']['addressComponent']
-            formatted_address = data['regeocode']['formatted_address']
-
-            return jsonify({
-                'success': True,
-                'address': formatted_address,
-                'province': address_component.get('province', ''),
-                'city': address_component.get('city', ''),
-                'district': address_component.get('district', '')
-            })
-        else:
-            return jsonify({'success': False, 'error': data.get('info', '逆地理编码失败')})
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)})
+        cache_key = f'regeo:{_round_location(location)}'
+    except ValueError:
+        return bad_request('坐标参数无效')
+
+    return jsonify(_amap_call(
+        AMAP_REGEOCODE_URL, {'location': location, 'extensions': 'base'},
+        _shape_reverse_geocode, '逆地理编码失败',
+        cache=RGEO_CACHE, cache_key=cache_key
+    ))
 
 @app.route('/search_poi')
 @login_required
@@ -304,52 +714,91 @@ def search_poi():
     location = request.args.get('location', '')
 
     if not keywords or not location:
-        return jsonify({'error': '参数缺失'}), 400
-
-    if not AMAP_SERVICE_KEY:
-        return jsonify({'success': False, 'error': '高德API配置缺失'})
-
-    url = 'https://restapi.amap.com/v3/place/around'
-    params = {
-        'keywords': keywords,
-        'location': location,
-        'key': AMAP_SERVICE_KEY,
-        'output': 'JSON',
-        'radius': 5000,
-        'offset': 20
-    }
+        return bad_request('参数缺失')
 
+    params = {'keywords': keywords, 'location': location, 'radius': POI_RADIUS, 'offset': POI_OFFSET}
     try:
-        response = requests.get(url, params=params, timeout=10)
-        data = response.json()
-
-        if data['status'] == '1':
-            pois = []
-            for poi in data.get('pois', []):
-                pois.append({
-                    'id': poi['id'],
-                    'name': poi['name'],
-                    'type': poi['type'],
-                    'address': poi['address'],
-                    'location': poi['location'],
-                    'distance': poi['distance']
-                })
-            return jsonify({'success': True, 'pois': pois})
-        else:
-            return jsonify({'success': False, 'error': data.get('info', '搜索失败')})
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)})
+        round_loc = _round_location(location)
+    except ValueError:
+        round_loc = location
+
+    return jsonify(_amap_call(
+        AMAP_POI_URL, params, _shape_search_poi, '搜索失败',
+        cache=POI_CACHE, cache_key=f'poi:{keywords}:{round_loc}:{POI_RADIUS}:{POI_OFFSET}'
+    ))
+
+# 数据库探测在后台线程中每30秒执行一次，/health通常只读取缓存的探测结果，不占用连接也不等待数据库
+DB_PROBE_INTERVAL = 30
+DB_PROBE_STALE_AFTER = 60
+DB_PROBE_CONNECT_TIMEOUT = 2
+_db_status = {'t': 0.0, 'v': 'unknown'}
+_db_probe_pid = None
+_db_probe_lock = threading.Lock()
+_db_probe_running = threading.Lock()
+
+def probe_database():
+    """同一时间只有一个调用方探测，其余直接返回；使用独立短超时连接，不经过连接池排队，也不触发建池"""
+    if not _db_probe_running.acquire(blocking=False):
+        return
+    try:
+        try:
+            conn = psycopg2.connect(connect_timeout=DB_PROBE_CONNECT_TIMEOUT, **DB_CONFIG)
+            try:
+                with conn.cursor() as cur:
+                    cur.execute('SELECT 1')
+                    cur.fetchone()
+            finally:
+                conn.close()
+            _db_status['v'] = 'connected'
+        except Exception as e:
+            print(f"⚠️ 数据库探测失败: {e}")
+            _db_status['v'] = 'disconnected'
+        _db_status['t'] = time.time()
+    finally:
+        _db_probe_running.release()
+
+def _db_probe_loop():
+    while True:
+        probe_database()
+        time.sleep(DB_PROBE_INTERVAL)
+
+def ensure_db_probe():
+    """首次健康检查时才启动探测线程，避免导入时（冷启动、flask init-db）就连接数据库；
+    gevent worker 下 threading 已被 monkey patch，启动的是协程"""
+    global _db_probe_pid
+    pid = os.getpid()
+    if _db_probe_pid != pid:
+        with _db_probe_lock:
+            if _db_probe_pid != pid:
+                threading.Thread(target=_db_probe_loop, name='db-probe', daemon=True).start()
+                _db_probe_pid = pid
+
+def db_status():
+    if time.time() - _db_status['t'] < DB_PROBE_STALE_AFTER:
+        return _db_status['v']
+    return 'unknown'
+
+def pool_available():
+    if DB_POOL is None:
+        return None
+    return DB_POOL.maxconn - len(DB_POOL._used)
 
-@app.route('/health')
+@app.route('/health', provide_automatic_options=False)
 def health_check():
-    db_status = 'connected' if get_db_connection() else 'disconnected'
+    ensure_db_probe()
+    # Vercel等平台在调用间隙冻结进程，后台探测会中断；结果过期时由一个请求当场探测，
+    # 其余并发请求不等待，直接返回'unknown'
+    if db_status() == 'unknown':
+        probe_database()
     return jsonify({
         'status': 'healthy',
-        'database': db_status,
+        'database': db_status(),
+        'pool_available': pool_available(),
         'amap_web_key': 'configured' if AMAP_WEB_KEY else 'missing',
         'amap_service_key': 'configured' if AMAP_SERVICE_KEY else 'missing'
     })
 
 # 本地开发
 if __name__ == '__main__':
+    init_db()
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,15 @@
+# gunicorn 部署配置：gunicorn -c gunicorn_conf.py wsgi:app
+# 使用 gevent 协程 worker，等待高德API和数据库响应时不阻塞其他请求
+import multiprocessing
+import os
+
+bind = os.getenv('BIND', '0.0.0.0:5000')
+worker_class = 'gevent'
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_connections = 1000
+
+
+def post_fork(server, worker):
+    # gevent worker 会自动 monkey patch 标准库，psycopg2 是C扩展，需要单独打补丁才能让出协程
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
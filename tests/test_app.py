@@ -0,0 +1,17 @@
+from app import app
+
+
+def test_flash_survives_redirect_and_render():
+    # 未登录访问受保护接口：闪存消息写入session后重定向，登录页读取session并按(category, message)渲染
+    client = app.test_client()
+    response = client.get('/geocode?address=x')
+    assert response.status_code == 302
+
+    response = client.get(response.headers['Location'])
+    assert response.status_code == 200
+    assert '请先登录以访问此页面。' in response.get_data(as_text=True)
+
+
+def test_json_provider_roundtrip():
+    data = {'success': True, 'address': '北京市', 'location': {'lng': 116.4, 'lat': 39.9}}
+    assert app.json.loads(app.json.dumps(data)) == data